@@ -3,9 +3,10 @@ import sys
 import logging
 import os.path
 from Qt import QtCore, QtGui, QtWidgets, __binding__
-from notetaker_db import NoteTakerSortFilterProxyModel, NoteTakerTableModel
+from notetaker_db import NoteTakerSortFilterProxyModel, NoteTakerTableModel, SQLStats
 
-logging.basicConfig(level=logging.DEBUG)
+# Debug output is only wanted while developing, and formatting it on every refresh slows the table down
+logging.basicConfig(level=logging.DEBUG if os.environ.get('NOTETAKER_DEBUG') else logging.WARNING)
 logger = logging.getLogger('notetaker')
 
 
@@ -19,6 +20,14 @@ class NoteTaker(QtWidgets.QMainWindow):
     """
 
     version = '0.1.2'
+    # Milliseconds to wait after the last keystroke in the filter box before the view is refiltered
+    # TODO: Make this configurable in the preferences dialog
+    filter_delay = 300
+    # Milliseconds to collect notes committed in quick succession before writing them in one transaction
+    commit_delay = 50
+    commit_shortcuts = (QtGui.QKeySequence('Ctrl+Return'), QtGui.QKeySequence('Ctrl+Enter'))
+    # Theme icons are looked up once per process and shared by every window, see theme_icon
+    _theme_icons = {}
 
     def __init__(self, parent=None):
         super(NoteTaker, self).__init__(parent)
@@ -28,15 +37,34 @@ class NoteTaker(QtWidgets.QMainWindow):
         # TODO: Support opening a db based on passed-in arguments
         self.current_user = None
         self.current_db = None
+        # Set when this window commits a note, so the view scrolls to it once it is appended to the table
+        self.scroll_to_new_notes = False
+        # (text, user, attachments) tuples waiting for commitTimer, see flush_notes
+        self.pending_notes = []
+        # Set while a login started by commit_new_note is being verified, so the note is committed once it succeeds
+        self.commit_after_login = False
 
         # Build the UI
         self.setup_ui()
 
+        # Connect to the database in the background so the window is shown before the database is touched
+        self.load_database()
+
         # TODO: Automatically check for updates to notes
 
         # TODO: Allow editing or inserting new notes
 
         # TODO: Attachment mechanism to support one or more arbitrary file types. Support drag and drop.
+
+    @classmethod
+    def theme_icon(cls, name):
+        """
+        Returns the named icon from the current icon theme. Theme lookups search the icon directories on disk, so
+        each icon is only looked up the first time it is requested.
+        """
+        if name not in cls._theme_icons:
+            cls._theme_icons[name] = QtGui.QIcon.fromTheme(name)
+        return cls._theme_icons[name]
         
     def setup_ui(self):
         # Set up basic dimensions and central layout
@@ -58,12 +86,24 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.dbconfigComboBox.setEditable(True)
         self.dbconfigComboBox.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Preferred)
         self.dbconfigComboBox.setLineEdit(self.dbconfigLineEdit)
-        # TODO: Remember database from previous session and open automatically
         # TODO: Make this field an editable dropdown that remembers up to N previous databases
-        self.dbconfigLineEdit.setText('notes.db')
-        # Set up data model
-        self.sourceTableModel = NoteTakerTableModel(self.db_type, self.dbconfigLineEdit.text())
-        self.current_db = self.dbconfigLineEdit.text()
+        # The database from the previous session is opened in the background as soon as the window is built
+        self.settings = QtCore.QSettings('NoteTaker', 'NoteTaker')
+        self.dbconfigLineEdit.setText(self.settings.value('last_database', 'notes.db'))
+        # Set up data model. The database is connected to by load_database once the UI is built.
+        self.sourceTableModel = NoteTakerTableModel()
+        self.sourceTableModel.databaseOpened.connect(self.database_opened)
+        self.sourceTableModel.firstPageLoaded.connect(self.first_page_loaded)
+        self.sourceTableModel.databaseError.connect(self.database_error)
+        self.sourceTableModel.notesAppended.connect(self.notes_appended)
+        self.sourceTableModel.exportFinished.connect(self.export_finished)
+        self.sourceTableModel.exportError.connect(self.export_error)
+        self.sourceTableModel.attachmentsSaved.connect(self.attachments_saved)
+        self.sourceTableModel.attachmentsError.connect(self.attachments_error)
+        self.sourceTableModel.notesCommitted.connect(self.commit_finished)
+        self.sourceTableModel.commitError.connect(self.commit_error)
+        self.sourceTableModel.loginChecked.connect(self.login_checked)
+        self.sourceTableModel.loginError.connect(self.login_error)
         self.proxyTableModel = NoteTakerSortFilterProxyModel()
         self.proxyTableModel.setSourceModel(self.sourceTableModel)
         # TODO: Add dropdown to select db type (or detect automatically)
@@ -89,7 +129,12 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.filterHorizontalLayout.addWidget(self.filterHorizontalLabel)
         self.filterLineEdit = QtWidgets.QLineEdit(self.filterFrame)
         # TODO: Implement find-as-you-type to encompass date
-        self.filterLineEdit.textChanged.connect(self.filter_view)
+        # Restart a single-shot timer on each keystroke so the view is only refiltered once typing pauses
+        self.filterTimer = QtCore.QTimer(self)
+        self.filterTimer.setSingleShot(True)
+        self.filterTimer.setInterval(self.filter_delay)
+        self.filterTimer.timeout.connect(self.filter_view)
+        self.filterLineEdit.textChanged.connect(lambda txt: self.filterTimer.start())
         self.filterHorizontalLayout.addWidget(self.filterLineEdit)
         self.verticalLayout.addWidget(self.filterFrame)
 
@@ -101,19 +146,25 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.tableView = QtWidgets.QTableView(self.splitter)
         self.tableView.setModel(self.proxyTableModel)
         self.tableView.setFont(QtGui.QFont('Courier New'))   # Probably not cross platform
-        self.tableView.resizeColumnsToContents()
         self.tableView.setSortingEnabled(True)
+        self.tableView.doubleClicked.connect(self.save_attachments)
         # TODO: Fix sorting (most recent at bottom)
         # __binding__ checks are to handle a caveat https://github.com/mottosso/Qt.py/blob/master/CAVEATS.md#qtwidgetsqheaderviewsetresizemode
         if __binding__ in ("PyQt4", "PySide"):
             self.tableView.horizontalHeader().setResizeMode(1, QtWidgets.QHeaderView.Stretch)
         else:
             self.tableView.horizontalHeader().setSectionResizeMode(1, QtWidgets.QHeaderView.Stretch)
+            # Column resizes after each commit sample the rows around the visible ones rather than up to 1000 rows
+            self.tableView.horizontalHeader().setResizeContentsPrecision(32)
         self.tableView.sortByColumn(0, QtCore.Qt.AscendingOrder)
+        # Rows are sized when they are loaded rather than by ResizeToContents, which measures every row on each layout
         if __binding__ in ("PyQt4", "PySide"):
-            self.tableView.verticalHeader().setResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+            self.tableView.verticalHeader().setResizeMode(QtWidgets.QHeaderView.Interactive)
         else:
-            self.tableView.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
+            self.tableView.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Interactive)
+        self.proxyTableModel.rowsInserted.connect(self.resize_inserted_rows)
+        self.proxyTableModel.modelReset.connect(self.tableView.resizeRowsToContents)
+        self.proxyTableModel.layoutChanged.connect(self.tableView.resizeRowsToContents)
         self.noteFrame = QtWidgets.QFrame(self.splitter)
         self.noteFrame.setFrameShape(QtWidgets.QFrame.StyledPanel)
         self.noteFrame.setFrameShadow(QtWidgets.QFrame.Raised)
@@ -130,8 +181,14 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.commitButton.setText('Commit')
         self.commitButton.setStatusTip('Click or press Control+Enter to commit this message to the database')
         self.commitButton.clicked.connect(self.commit_new_note)
-        QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+Return'), self, self.commit_new_note)
-        QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+Enter'), self, self.commit_new_note)
+        self.commitTimer = QtCore.QTimer(self)
+        self.commitTimer.setSingleShot(True)
+        self.commitTimer.setInterval(self.commit_delay)
+        self.commitTimer.timeout.connect(self.flush_notes)
+        for shortcut in self.commit_shortcuts:
+            QtWidgets.QShortcut(shortcut, self, self.commit_new_note)
+        # Developer statistics
+        QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+Shift+D'), self, self.show_stats)
         self.horizontalLayout.addWidget(self.commitButton)
         self.verticalLayout.addWidget(self.splitter)
 
@@ -139,6 +196,19 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.statusbar = QtWidgets.QStatusBar(self)
         self.setStatusBar(self.statusbar)
 
+        # Message boxes are built once and reused rather than recreated, with their icons, on every export or login
+        self.exportSelectionMsg = QtWidgets.QMessageBox()
+        self.exportSelectionMsg.setIcon(QtWidgets.QMessageBox.Question)
+        self.exportSelectionMsg.setText('The current view is filtered. Select Yes to export only the visible data or No to export all available data.')
+        self.exportSelectionMsg.setWindowTitle('Export Selection?')
+        self.exportSelectionMsg.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No |
+                                                   QtWidgets.QMessageBox.Cancel)
+        self.invalidCredentialsMsg = QtWidgets.QMessageBox()
+        self.invalidCredentialsMsg.setIcon(QtWidgets.QMessageBox.Warning)
+        self.invalidCredentialsMsg.setText('Incorrect Username or Password')
+        self.invalidCredentialsMsg.setWindowTitle('Invalid Credentials')
+        self.invalidCredentialsMsg.setStandardButtons(QtWidgets.QMessageBox.Ok)
+
         # TODO: Allow user to create custom hotkey-able buttons to insert common text e.g. "Test complete. Pass"
         self.toolBar = QtWidgets.QToolBar(self)
         self.addToolBar(QtCore.Qt.TopToolBarArea, self.toolBar)
@@ -151,12 +221,12 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.setMenuBar(self.menubar)
 
         # File menu options
-        self.actionLoad = QtWidgets.QAction(QtGui.QIcon.fromTheme("document-open"), '&Load Database', self)
+        self.actionLoad = QtWidgets.QAction(self.theme_icon("document-open"), '&Load Database', self)
         self.actionLoad.setShortcut('Ctrl+L')
         self.actionLoad.setStatusTip('Load a NoteTaker database')
         self.actionLoad.triggered.connect(self.browse_db_connection)
 
-        self.actionExport = QtWidgets.QAction(QtGui.QIcon.fromTheme("document-save-as"), '&Export Notes', self)
+        self.actionExport = QtWidgets.QAction(self.theme_icon("document-save-as"), '&Export Notes', self)
         self.actionExport.setShortcut('Ctrl+S')
         self.actionExport.setStatusTip('Export notes')
         self.actionExport.triggered.connect(self.onExportClicked)
@@ -177,7 +247,7 @@ class NoteTaker(QtWidgets.QMainWindow):
         self.userDialog.triggered.connect(self.user_dialog)
 
         # Help Menu options
-        self.actionAbout = QtWidgets.QAction(QtGui.QIcon.fromTheme('system-help'), '&About', self)
+        self.actionAbout = QtWidgets.QAction(self.theme_icon('system-help'), '&About', self)
         self.actionAbout.setStatusTip('Version and Copyright information')
         self.actionAbout.triggered.connect(self._about)
 
@@ -199,35 +269,64 @@ class NoteTaker(QtWidgets.QMainWindow):
         
 
     def browse_db_connection(self):
-        fl = QtWidgets.QFileDialog.getOpenFileName(caption='Open database file', directory='')
-        if any(fl):
-            self.dbconfigLineEdit.setText(fl[0])
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(caption='Open database file', directory='')
+        if path:
+            self.dbconfigLineEdit.setText(path)
 
     def commit_new_note(self):
-        attempts = 0
-        while not self.current_user and attempts < 3:
-            self.user_dialog()
-            attempts += 1
-
-        if self.current_user:  # If someone is properly logged in
-            result = self.sourceTableModel.commit_new_note(self.textEdit.toPlainText(), self.current_user, )
-            self.textEdit.clear()
-            self.statusbar.showMessage(result)
-            self.tableView.resizeColumnToContents(0)
-            self.tableView.resizeColumnToContents(2)
-            self.tableView.resizeColumnToContents(3)
-            self.tableView.resizeRowsToContents()
+        if self.sourceTableModel.session is None:
+            self.statusbar.showMessage('No database loaded', 10000)
+            return
+
+        if not self.current_user:
+            # The note stays in the editor and is committed by login_checked if the login succeeds
+            if not self.commit_after_login:
+                # Set before the dialog, since login_checked clears it and may run as soon as the login is started
+                self.commit_after_login = True
+                if not self.user_dialog():
+                    self.commit_after_login = False
+            return
+
+        self.pending_notes.append((self.textEdit.toPlainText(), self.current_user, None))
+        self.textEdit.clear()
+        # Not restarted by later notes, so a steady stream of commits is still written every commit_delay ms
+        if not self.commitTimer.isActive():
+            self.commitTimer.start()
+
+    def flush_notes(self):
+        self.commitTimer.stop()
+        if not self.pending_notes:
+            return
+        notes, self.pending_notes = self.pending_notes, []
+        self.scroll_to_new_notes = True
+        self.sourceTableModel.start_commit(notes)
+
+    def commit_finished(self, message):
+        self.statusbar.showMessage(message)
+
+    def commit_error(self, message):
+        self.scroll_to_new_notes = False
+        self.statusbar.showMessage('Commit failed: {}'.format(message))
+
+    def notes_appended(self, count):
+        # The new note only reaches the table once the model's refresh query completes
+        self.tableView.resizeColumnToContents(0)
+        self.tableView.resizeColumnToContents(2)
+        self.tableView.resizeColumnToContents(3)
+        # Notes from other clients arrive on the model's update timer and should not move the view
+        if self.scroll_to_new_notes:
+            self.scroll_to_new_notes = False
             self.tableView.scrollToBottom()
+
+    def resize_inserted_rows(self, parent, first, last):
+        # Only the rows just added by a refresh or fetchMore need sizing to fit their text
+        for row in range(first, last + 1):
+            self.tableView.resizeRowToContents(row)
             
     def onExportClicked(self):
         # TODO: Pop up a window if data is filtered and ask if user would like filtered or all data exported
         if self.filterLineEdit.text() != '':
-            msg = QtWidgets.QMessageBox()
-            msg.setIcon(QtWidgets.QMessageBox.Question)
-            msg.setText('The current view is filtered. Select Yes to export only the visible data or No to export all available data.')
-            msg.setWindowTitle('Export Selection?')
-            msg.setStandardButtons(QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No | QtWidgets.QMessageBox.Cancel)
-            result = msg.exec_()
+            result = self.exportSelectionMsg.exec_()
             if result == QtWidgets.QMessageBox.Yes:
                 export_flag = 'filtered'
             elif result == QtWidgets.QMessageBox.No:
@@ -241,58 +340,114 @@ class NoteTaker(QtWidgets.QMainWindow):
         path = QtWidgets.QFileDialog.getSaveFileName(self, 'Save File', '', 'CSV (*.csv)')[0]
         if path != '':
             logger.debug('Found a file to save to: {}'.format(path))
+            # Exports can be large, so they are written on a worker thread, see export_finished
             if export_flag == 'filtered':
+                self.statusbar.showMessage('Exporting to "{}"...'.format(path))
                 self.proxyTableModel.export_data_filt(path)
             elif export_flag == 'all':
-                self.sourceTableModel.export_data(path)
+                self.statusbar.showMessage('Exporting to "{}"...'.format(path))
+                self.sourceTableModel.start_export(path)
             else:
                 logger.warning('Export option "{}" not configured'.format(repr(export_flag))) 
-            logger.debug('Export complete')
-            self.statusbar.showMessage('Export complete! File saved as "{}"'.format(path))
         else:
             logger.debug('User cancelled save')
+
+    def export_finished(self, path):
+        logger.debug('Export complete')
+        self.statusbar.showMessage('Export complete! File saved as "{}"'.format(path))
+
+    def export_error(self, message):
+        self.statusbar.showMessage('Export failed: {}'.format(message))
+
+    def save_attachments(self, index):
+        # Double clicking a note's attachments cell saves them into a chosen directory
+        if index.column() != 4 or not index.data():
+            return
+        note_id = self.sourceTableModel.note_id_at(self.proxyTableModel.mapToSource(index).row())
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self, 'Save attachments to')
+        if directory:
+            self.statusbar.showMessage('Saving attachments to "{}"...'.format(directory))
+            self.sourceTableModel.start_save_attachments(note_id, directory)
+
+    def attachments_saved(self, directory):
+        self.statusbar.showMessage('Attachments saved to "{}"'.format(directory))
+
+    def attachments_error(self, message):
+        self.statusbar.showMessage('Saving attachments failed: {}'.format(message))
             
 
     def user_dialog(self):
         # TODO: Show currently logged in user in the GUI
         # TODO: allow config file to populate table 'user' when a new database is generated
+        # Returns True if a login was started
         login = Login()
-        login.exec_()
+        if login.exec_() != QtWidgets.QDialog.Accepted:
+            return False
         username, pw = login.get_creds()
-
-        if self.sourceTableModel.is_valid_user(user=username, passwd=pw):
+        # The password is checked on a worker thread, see login_checked
+        self.statusbar.showMessage('Verifying "{}"...'.format(username))
+        self.sourceTableModel.start_login(username, pw)
+        return True
+
+    def login_checked(self, username, valid):
+        commit_after_login, self.commit_after_login = self.commit_after_login, False
+        if valid:
             self.current_user = username
             self.statusbar.showMessage('Successfully logged in as "{}"'.format(self.current_user), 10000)
             self.setWindowTitle('{} - {} - {}'.format(self.program_title, self.current_user, self.current_db))
+            if commit_after_login:
+                self.commit_new_note()
         else:
-            msg = QtWidgets.QMessageBox()
-            msg.setIcon(QtWidgets.QMessageBox.Warning)
-            msg.setText('Incorrect Username or Password')
-            msg.setWindowTitle('Invalid Credentials')
-            msg.setStandardButtons(QtWidgets.QMessageBox.Ok)
-            msg.exec_()
+            self.statusbar.clearMessage()
+            self.invalidCredentialsMsg.exec_()
+
+    def login_error(self, message):
+        self.commit_after_login = False
+        self.statusbar.showMessage('Login failed: {}'.format(message))
 
     def load_database(self):
-        result = self.sourceTableModel.initiate_db_connection(self.db_type, self.dbconfigLineEdit.text())
-        if result:
-            self.current_db = result
+        # Notes still waiting to be written belong to the database that is currently open
+        self.flush_notes()
+        db = self.dbconfigLineEdit.text()
+        self.statusbar.showMessage('Connecting to "{}"...'.format(db))
+        self.sourceTableModel.open_database(self.db_type, db)
+
+    def database_opened(self, db):
+        if db:
+            self.current_db = db
+            self.settings.setValue('last_database', db)
             self.setWindowTitle('{} - {} - {}'.format(self.program_title, self.current_user, self.current_db))
             self.statusbar.showMessage('Successfully connected to "{}"'.format(self.current_db), 10000)
-            self.tableView.resizeRowsToContents()
-            self.tableView.scrollToBottom()
-            # Ensure user logs in again when a new database is loaded
+            # Ensure user logs in again when a new database is loaded. A login still being checked against the
+            # previous database is dropped by the model, so stop waiting for it.
             self.current_user = None
+            self.commit_after_login = False
+
+    def first_page_loaded(self, db):
+        # Only the first page of notes is loaded, so this measures at most page_size rows. The text column is
+        # stretched and the attachments column keeps its default width.
+        self.tableView.resizeColumnToContents(0)
+        self.tableView.resizeColumnToContents(2)
+        self.tableView.resizeColumnToContents(3)
+        self.tableView.scrollToBottom()
+
+    def database_error(self, message):
+        self.statusbar.showMessage('Could not connect to database: {}'.format(message))
 
     def filter_view(self):
         filter_txt = self.filterLineEdit.text()
         logger.debug('Filtering text "{}"'.format(filter_txt))
         self.proxyTableModel.update_table_view(filter_txt)
 
+    def show_stats(self):
+        self.statusbar.showMessage('{} SQL statements executed'.format(SQLStats.statement_count), 10000)
+
     def closeEvent(self, *args, **kwargs):
         # Catch all types of close events to handle database closing gracefully
         self._exit()
 
     def _exit(self):
+        self.flush_notes()
         logger.debug('Closing database sessions')
         self.sourceTableModel.close()
         self.close()
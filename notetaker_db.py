@@ -1,17 +1,251 @@
 import logging
 import csv
-import datetime as dt
+import base64
+import functools
+import hashlib
+import hmac
+import os
+import shutil
+import sqlite3
+import tempfile
 from Qt import QtCore, QtGui, QtWidgets
-from collections import defaultdict
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, ForeignKey, create_engine, or_
-from sqlalchemy.orm import sessionmaker
-from passlib.hash import pbkdf2_sha256
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, ForeignKey, Index, create_engine, event, insert, or_, func
+from sqlalchemy.orm import sessionmaker, relationship, deferred
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import table, column, select, bindparam
 
 logger = logging.getLogger('notetaker')
+sql_logger = logging.getLogger('notetaker.sql')
+# SQL statements are only logged when this environment variable is set, see count_sql_statement
+DEBUG_SQL = bool(os.environ.get('NOTETAKER_DEBUG_SQL'))
+# SQLite databases are switched to write-ahead logging only when this environment variable is set. WAL relies on shared
+# memory between the clients, so it must not be used for a database that clients on other hosts open over a network
+# share. See set_sqlite_pragmas.
+USE_WAL = bool(os.environ.get('NOTETAKER_WAL'))
+# Write buffer for CSV exports, so the many small rows are written to disk in large blocks
+EXPORT_BUFFER_SIZE = 1 << 20
 
 Base = declarative_base()
 
+# Trigram full-text index over note text. It is an external content table, so it stores no copy of the text and is
+# kept in sync with the note table by triggers. Trigram tokens let it answer unanchored LIKE patterns.
+NOTE_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(text, content='note', content_rowid='note_id', "
+    "tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN "
+    "INSERT INTO note_fts(rowid, text) VALUES (new.note_id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN "
+    "INSERT INTO note_fts(note_fts, rowid, text) VALUES ('delete', old.note_id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE ON note BEGIN "
+    "INSERT INTO note_fts(note_fts, rowid, text) VALUES ('delete', old.note_id, old.text); "
+    "INSERT INTO note_fts(rowid, text) VALUES (new.note_id, new.text); END",
+)
+note_fts = table('note_fts', column('rowid'), column('text'))
+
+# Local time with millisecond resolution, evaluated by SQLite as part of the INSERT. This matches the local timestamps
+# previously written from Python and, unlike a server_default, also works for tables created before it was added.
+LOCAL_TIMESTAMP = func.strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tunes each new SQLite connection for several clients sharing one database file. busy_timeout makes a locked
+    database wait instead of failing immediately. If USE_WAL is set, WAL lets readers proceed while a note is being
+    committed; otherwise the database keeps the journal mode it already has. The page cache is raised to about 20MB
+    so scrolling and filtering a large table mostly avoid re-reading pages.
+    """
+    cursor = dbapi_connection.cursor()
+    if USE_WAL:
+        cursor.execute('PRAGMA journal_mode=WAL')
+    # Skipping the sync on every commit is only safe with a write-ahead log. With a rollback journal the default
+    # synchronous=FULL is kept.
+    if cursor.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal':
+        cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    # Negative values are in KiB rather than pages
+    cursor.execute('PRAGMA cache_size=-20000')
+    cursor.close()
+
+
+class SQLStats(object):
+    # Number of SQL statements executed by all engines, shown by NoteTaker's statistics shortcut
+    statement_count = 0
+
+
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    """
+    before_cursor_execute listener that counts statements instead of echoing them. Only logs the statement itself if
+    NOTETAKER_DEBUG_SQL is set, and leaves formatting to the logging module so it costs nothing when filtered out.
+    """
+    SQLStats.statement_count += 1
+    if DEBUG_SQL:
+        sql_logger.debug('%s %r', statement, parameters)
+
+
+def set_sqlite_query_only(dbapi_connection, connection_record):
+    """
+    Marks a pooled SQLite connection as read-only so the read engine can never take the database write lock
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only=ON')
+    cursor.close()
+
+
+def sqlite_supports_note_fts():
+    """
+    Returns True if the SQLite library used by Python has FTS5 with the trigram tokenizer, i.e. is SQLite 3.34 or
+    newer built with FTS5
+    """
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(text, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+def create_note_fts(engine):
+    """
+    Creates the note_fts index and its triggers if they do not exist yet, indexing any notes already present.
+    Returns False if this SQLite build lacks FTS5 or the trigram tokenizer. The triggers live in the shared database
+    file and use the index on every change to a note, so if another client has already created them such a build
+    cannot write to the database and RuntimeError is raised instead.
+    """
+    if not sqlite_supports_note_fts():
+        with engine.connect() as conn:
+            exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'note_fts'").scalar()
+        if exists:
+            raise RuntimeError('This database has a full-text note index, which requires SQLite 3.34 or newer with '
+                               'FTS5. Python is using SQLite {}.'.format(sqlite3.sqlite_version))
+        logger.warning('Full-text note index unavailable, filtering with LIKE instead: SQLite {} lacks FTS5 or the '
+                       'trigram tokenizer'.format(sqlite3.sqlite_version))
+        return False
+    try:
+        with engine.begin() as conn:
+            exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'note_fts'").scalar()
+            for statement in NOTE_FTS_DDL:
+                conn.exec_driver_sql(statement)
+            if not exists:
+                conn.exec_driver_sql("INSERT INTO note_fts(note_fts) VALUES ('rebuild')")
+    except OperationalError as e:
+        logger.warning('Full-text note index unavailable, filtering with LIKE instead: {}'.format(e))
+        return False
+    return True
+
+
+# PBKDF2 iterations of the dummy hash below, matching passlib's pbkdf2_sha256 default used for the stored hashes
+PBKDF2_ROUNDS = 29000
+
+
+def _ab64_encode(data):
+    # passlib's base64 variant uses '.' instead of '+' and drops the padding
+    return base64.b64encode(data).decode('ascii').replace('+', '.').rstrip('=')
+
+
+def _ab64_decode(data):
+    data = data.replace('.', '+')
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+# Checked instead of a stored hash when a login names an unknown user, so that it takes as long as a wrong password
+# for a real one and the response time does not reveal which usernames exist. Its random key matches no password.
+DUMMY_PWHASH = '$pbkdf2-sha256${}${}${}'.format(PBKDF2_ROUNDS, _ab64_encode(os.urandom(16)),
+                                                _ab64_encode(os.urandom(32)))
+
+
+def verify_password(passwd, pwhash):
+    """
+    Checks passwd against a passlib pbkdf2_sha256 hash ('$pbkdf2-sha256$<rounds>$<salt>$<key>') using hashlib's
+    native PBKDF2 and a constant-time comparison
+    """
+    rounds, salt, key = pwhash.split('$')[2:]
+    salt, key = _ab64_decode(salt), _ab64_decode(key)
+    return hmac.compare_digest(hashlib.pbkdf2_hmac('sha256', passwd.encode('utf-8'), salt, int(rounds), len(key)), key)
+
+
+def add_missing_columns(engine):
+    """
+    Adds any mapped columns missing from tables created by older versions, since create_all only creates new tables
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for mapped_table in Base.metadata.sorted_tables:
+            existing = set(c['name'] for c in inspector.get_columns(mapped_table.name))
+            for col in mapped_table.columns:
+                if col.name not in existing:
+                    logger.info('Adding column {}.{}'.format(mapped_table.name, col.name))
+                    conn.exec_driver_sql('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        mapped_table.name, col.name, col.type.compile(dialect=engine.dialect)))
+
+
+def insert_returning_ids(session, table, rows):
+    """
+    Inserts rows, a list of parameter dicts, into table and returns their new primary keys in the same order. Uses
+    the table rather than a mapped class so that it stays a plain Core insert rather than taking the ORM bulk insert
+    path.
+    """
+    id_column = table.primary_key.columns[0]
+    if session.get_bind().dialect.name == 'sqlite':
+        # Asking SQLAlchemy for the ids in parameter order makes it fall back to one INSERT per row on SQLite. Rowids
+        # of a multi-row INSERT are allocated in VALUES order within the write transaction, so every row goes into a
+        # single statement and sorting the returned ids gives the order of rows.
+        return sorted(session.scalars(insert(table).returning(id_column), rows))
+    return session.scalars(insert(table).returning(id_column, sort_by_parameter_order=True), rows).all()
+
+
+# The process umask, read once at import because the only way to read it also sets it. Stored attachments are given
+# the permissions a newly created file would get, see store_attachment_file.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def store_attachment_file(src_path, attachment_dir):
+    """
+    Copies the file at src_path into attachment_dir, named after the SHA-256 of its contents. Files whose contents
+    are already stored are not written again. Returns the hex digest, the stored path relative to attachment_dir
+    and the size in bytes.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    os.makedirs(attachment_dir, exist_ok=True)
+    # Hash while copying to a temporary file so the source is only read once
+    fd, tmp_path = tempfile.mkstemp(dir=attachment_dir)
+    try:
+        with open(src_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1 << 20), b''):
+                sha.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+        digest = sha.hexdigest()
+        rel_path = '{}/{}'.format(digest[:2], digest)
+        dest = os.path.join(attachment_dir, rel_path)
+        if os.path.exists(dest):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            # mkstemp creates the file readable by its owner only, so other users sharing the attachment directory
+            # could not open it
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+            os.replace(tmp_path, dest)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest, rel_path, size
+
+
+def wildcard_to_like(filter_txt):
+    """
+    Converts a wildcard filter ('*' matches anything, '?' matches one character) into an unanchored LIKE pattern
+    """
+    escaped = filter_txt.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%{}%'.format(escaped.replace('*', '%').replace('?', '_'))
+
 
 class User(Base):
     __tablename__ = 'user'
@@ -26,21 +260,22 @@ class User(Base):
        
 class Note(Base):
     __tablename__ = 'note'
+    # Notes are listed in creation order, optionally restricted to a single user
+    __table_args__ = (Index('ix_note_user_datetime', 'user', 'datetime'),)
     
     # Contains only the latest edited notes for any given item 
     note_id = Column(Integer, primary_key=True)
-    datetime = Column(DateTime)
+    datetime = Column(DateTime, index=True, default=LOCAL_TIMESTAMP)
     text = Column(String)
     user = Column(String, ForeignKey('user.username'))
-    last_update = Column(DateTime)
+    last_update = Column(DateTime, index=True, default=LOCAL_TIMESTAMP)
+    # Attachments for a set of notes are loaded with one extra SELECT ... IN query instead of one query per note
+    attachments = relationship('Attachment', secondary='note_attachment', back_populates='notes', lazy='selectin')
     
     def __repr__(self):
         return "<Note(note_id='{}', datetime='{}', text='{}', user='{}', last_update='{}')>"\
             .format(self.note_id, self.datetime, self.text, self.user, self.last_update)
 
-    def __getitem__(self, item):
-        return (self.note_id, self.datetime, self.text, self.user, self.last_update)[item]
-
 
 class Attachment(Base):
     __tablename__ = 'attachment'
@@ -48,7 +283,14 @@ class Attachment(Base):
     attach_id = Column(Integer, primary_key=True)
     # Filename or other identifier
     name = Column(String)
-    data = Column(LargeBinary)
+    # File contents are stored outside the database under the model's attachment_dir, see store_attachment_file.
+    # path is relative to that directory and identical files are only stored once.
+    sha256 = Column(String(64))
+    path = Column(String)
+    size = Column(Integer)
+    # Contents of attachments added before they were stored on disk. Only loaded when .data is accessed.
+    data = deferred(Column(LargeBinary))
+    notes = relationship('Note', secondary='note_attachment', back_populates='attachments')
     
     def __repr__(self):
         return "<Attachment(name='{}', data='BINARY')>".format(self.name)
@@ -69,8 +311,8 @@ class NoteAttachment(Base):
     __tablename__ = 'note_attachment'
     
     id = Column(Integer, primary_key=True)
-    note_id = Column(Integer)
-    attach_id = Column(Integer)
+    note_id = Column(Integer, ForeignKey('note.note_id'), index=True)
+    attach_id = Column(Integer, ForeignKey('attachment.attach_id'), index=True)
     
     def __repr__(self):
         return "<NoteAttachment(note_id='{}',attach_id='{}')>".format(self.note_id, self.attach_id)
@@ -83,7 +325,7 @@ class Log(Base):
     # TODO: Set up triggers to support automatic logging
     log_id = Column(Integer, primary_key=True)
     # timestamp when the insertion/edit was made
-    timestamp = Column(DateTime)
+    timestamp = Column(DateTime, default=LOCAL_TIMESTAMP)
     # text is the 
     text = Column(String)
 
@@ -91,6 +333,74 @@ class Log(Base):
         return "<Log(timestamp='{}', text='{}')>".format(self.timestamp, self.text)
 
         
+# Filter criteria are built once with a bound pattern parameter, so each filter query reuses the same expression
+# objects and hits SQLAlchemy's compiled statement cache instead of constructing and compiling new SQL every time.
+# Patterns that need an ESCAPE clause are matched against the note table instead, since ESCAPE stops the trigram
+# index from being used.
+NOTE_FTS_FILTER = Note.note_id.in_(select(note_fts.c.rowid).where(note_fts.c.text.like(bindparam('pattern'))))
+NOTE_TEXT_FILTER = Note.text.ilike(bindparam('pattern'), escape='\\')
+# SQLite's LIKE already ignores case, so there the pattern is matched directly rather than against lower(text)
+NOTE_TEXT_FILTER_SQLITE = Note.text.like(bindparam('pattern'), escape='\\')
+# Filenames of a note's attachments joined by newlines. As a correlated subquery SQLite only evaluates it, through the
+# note_attachment.note_id index, for the rows a query actually returns, so paging still follows the datetime index.
+NOTE_ATTACHMENTS = select(func.group_concat(Attachment.name, '\n'))\
+    .join(NoteAttachment, NoteAttachment.attach_id == Attachment.attach_id)\
+    .where(NoteAttachment.note_id == Note.note_id)\
+    .scalar_subquery()
+# Only the displayed columns are selected, and executed with Session.execute, so notes come back as plain rows
+# without ORM instances or the legacy Query wrapper
+NOTE_ROWS = select(Note.note_id, Note.datetime, Note.text, Note.user, Note.last_update,
+                   NOTE_ATTACHMENTS.label('attachments'))
+# The same columns without note_id, in the order of the exported CSV. Exported rows are written as they come from the
+# database and the csv module formats each value with str(), which matches the table cells except for NULLs. The
+# table shows those as 'None', see _build_rows, while both exports write an empty field.
+NOTE_EXPORT_ROWS = select(Note.datetime, Note.text, Note.user, Note.last_update, NOTE_ATTACHMENTS.label('attachments'))
+NOTE_COUNT = select(func.count(Note.note_id))
+# Columns the table can be sorted by in SQL, indexed by table column. Attachments sort by their joined names.
+NOTE_SORT_COLUMNS = (Note.datetime, Note.text, Note.user, Note.last_update, NOTE_ATTACHMENTS)
+# (column, descending) order the table is loaded in unless the view asks for another
+DEFAULT_SORT_KEY = (0, False)
+NOTE_MAX_ID = select(func.max(Note.note_id))
+
+
+def sort_order(sort_key):
+    # ORDER BY clauses for a (column, descending) sort key. Ties are broken by note_id so that paging is stable.
+    column, descending = sort_key
+    order_by = (NOTE_SORT_COLUMNS[column], Note.note_id)
+    if descending:
+        order_by = [c.desc() for c in order_by]
+    return order_by
+USER_PWHASH = select(User.pwhash).where(User.username == bindparam('username'))
+
+
+class QueryJobSignals(QtCore.QObject):
+    # Emitted with the id of the job and the value returned by its function
+    finished = QtCore.Signal(int, object)
+    # Emitted with the id of the job and the exception raised by its function
+    failed = QtCore.Signal(int, object)
+
+
+class QueryJob(QtCore.QRunnable):
+    def __init__(self, job_id, fn, *args):
+        """
+        Runs fn(*args) on a QThreadPool worker thread and emits the result through self.signals.finished
+        """
+        super(QueryJob, self).__init__()
+        self.job_id = job_id
+        self.fn = fn
+        self.args = args
+        self.signals = QueryJobSignals()
+
+    def run(self):
+        try:
+            result = self.fn(*self.args)
+        except Exception as e:
+            logger.exception('Database query failed')
+            self.signals.failed.emit(self.job_id, e)
+        else:
+            self.signals.finished.emit(self.job_id, result)
+
+
 class NoteTakerSortFilterProxyModel(QtCore.QSortFilterProxyModel):
     def __init__(self, parent=None):
         """
@@ -99,135 +409,627 @@ class NoteTakerSortFilterProxyModel(QtCore.QSortFilterProxyModel):
         super(NoteTakerSortFilterProxyModel, self).__init__(parent)
         self.header = ('Creation Date', 'Text', 'User', 'Last Modified', 'Attachments')
 
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        # Sorting is done in SQL by the source model, so rows are passed through in the order it loaded them
+        self.sourceModel().sort(column, order)
+
     def update_table_view(self, filter_txt):
-        search = QtCore.QRegExp(filter_txt, QtCore.Qt.CaseInsensitive, QtCore.QRegExp.Wildcard)
-        self.setFilterRegExp(search)
-        self.setFilterKeyColumn(1)
+        # Filtering is done in SQL by the source model so that notes which have not been fetched yet are matched too
+        self.sourceModel().set_filter(filter_txt)
         
     def export_data_filt(self, path):
-        export_list = []
-        for row in range(self.rowCount()):
-            rowdata = {}
-            for col in range(self.columnCount()):
-                rowdata[self.header[col]] = self.data(self.index(row, col))
-            export_list.append(rowdata)
-        with open(path, 'w', newline='') as fl:
-            writer = csv.DictWriter(fl, fieldnames=self.header)
-            writer.writeheader()
-            for line in export_list:
-                writer.writerow(line)
+        """
+        Exports the notes matching the current filter, in the current order, on a worker thread. They are streamed
+        from the database like the full export rather than fetched into the view first, so the export is not limited
+        to the pages loaded so far. exportFinished or exportError is emitted by the source model when done.
+        """
+        source = self.sourceModel()
+        source.start_export(path, source.filter_txt, source.sort_key)
 
 
 class NoteTakerTableModel(QtCore.QAbstractTableModel):
-    def __init__(self, db_type, db, update_rate=2000, parent=None):
+    # Emitted with the database path once open_database has connected to it
+    databaseOpened = QtCore.Signal(str)
+    # Emitted with the database path once the first page of notes from a newly opened database is in the table
+    firstPageLoaded = QtCore.Signal(str)
+    # Emitted with an error message if open_database could not connect
+    databaseError = QtCore.Signal(str)
+    # Emitted with the number of notes found by refresh_data
+    notesAppended = QtCore.Signal(int)
+    # Emitted with the file path once start_export has written it
+    exportFinished = QtCore.Signal(str)
+    # Emitted with an error message if start_export could not write the file
+    exportError = QtCore.Signal(str)
+    # Emitted with a status message once start_commit has written its notes
+    notesCommitted = QtCore.Signal(str)
+    # Emitted with the directory once start_save_attachments has written a note's attachments into it
+    attachmentsSaved = QtCore.Signal(str)
+    # Emitted with an error message if start_save_attachments could not write the attachments
+    attachmentsError = QtCore.Signal(str)
+    # Emitted with an error message if start_commit could not write its notes
+    commitError = QtCore.Signal(str)
+    # Emitted with the username and whether the password was correct once start_login has checked them
+    loginChecked = QtCore.Signal(str, bool)
+    # Emitted with an error message if start_login could not check the credentials
+    loginError = QtCore.Signal(str)
+    # Number of notes fetched from the database each time the view scrolls past the rows already loaded
+    page_size = 200
+    # Milliseconds to wait after the database file changes before looking for new notes
+    refresh_delay = 100
+    # Milliseconds between polls while the database files are watched. File notifications do not cover writes made
+    # by other hosts to a database on a network share, so the database is still polled, only less often.
+    watched_update_rate = 15000
+
+    def __init__(self, db_type=None, db=None, update_rate=2000, parent=None):
         """
-        Model used to interact with the database via sqlalchemy
+        Model used to interact with the database via sqlalchemy. If db is given it is connected to immediately and
+        the first page of notes is loaded in the background, otherwise call open_database or initiate_db_connection.
         """
         super(NoteTakerTableModel, self).__init__(parent)
         self.session = None
-        self.datatable = [[]]
+        self.ReadSession = None
+        self.read_engine = None
+        self.datatable = []
+        self.total_rows = 0
+        # Newest note id included in datatable, or None before anything has been loaded
+        self.max_note_id = None
+        # filter_txt is the filter applied to the rows currently in datatable, pending_filter_txt the latest requested
+        self.filter_txt = ''
+        self.pending_filter_txt = ''
+        # (column, descending) order of the rows in datatable and the latest order requested, see sort
+        self.sort_key = DEFAULT_SORT_KEY
+        self.pending_sort_key = DEFAULT_SORT_KEY
+        # Incremented for every filter query so that results arriving out of order can be recognised as stale
+        self.query_id = 0
+        # True while the latest filter query is running, see refresh_data
+        self.filter_pending = False
+        # Set when refresh_data was skipped because of a running filter query
+        self.refresh_after_filter = False
+        self.connection_id = 0
+        self.refresh_id = 0
+        self.use_fts = False
+        self.use_sqlite_like = False
+        self.attachment_dir = None
+        # Database opened by open_database whose first page of notes has not been loaded yet
+        self.opened_db = None
+        # Digests of logins verified against the current database, see is_valid_user. The random key means the
+        # digests are of no use outside this process.
+        self._login_key = os.urandom(32)
+        self._valid_logins = set()
+        # Recently used filter results, see _load_rows
+        self._cached_query_rows = functools.lru_cache(maxsize=64)(self._query_rows)
         self.header = ('Creation Date', 'Text', 'User', 'Last Modified', 'Attachments')
 
-        self.initiate_db_connection(db_type, db)
+        # Pick up notes committed by other clients. QObject.startTimer would only deliver timerEvents, so the interval is
+        # set on the QTimer itself for timeout to fire. Databases that can be watched are polled less often, see
+        # watch_database.
+        # TODO: Add option to set update_rate in preferences dialog
+        self.dataUpdateTimer = QtCore.QTimer(self)
+        self.update_rate = update_rate
+        self.dataUpdateTimer.setInterval(update_rate)
+        self.dataUpdateTimer.timeout.connect(self.refresh_data)
+        self.dataUpdateTimer.start()
+        # Changes to SQLite database files start refreshTimer, so a burst of writes causes a single refresh
+        self.dbWatcher = QtCore.QFileSystemWatcher(self)
+        self.dbWatcher.fileChanged.connect(self._on_database_file_changed)
+        self.refreshTimer = QtCore.QTimer(self)
+        self.refreshTimer.setSingleShot(True)
+        self.refreshTimer.setInterval(self.refresh_delay)
+        self.refreshTimer.timeout.connect(self.refresh_data)
+        # Commits run one at a time on their own thread, as they share self.session, see start_commit
+        self.writePool = QtCore.QThreadPool(self)
+        self.writePool.setMaxThreadCount(1)
 
-        # self.dataUpdateTimer = QtCore.QTimer(self)
-        # self.dataUpdateTimer.timeout.connect(self.refresh_data)
-        # self.dataUpdateTimer.startTimer(update_rate)
+        if db is not None:
+            self.initiate_db_connection(db_type, db)
 
     def initiate_db_connection(self, db_type, db):
-        # Connect to the database specified
+        """
+        Connects to the database specified, blocking until connected. The first page of notes is then loaded on a
+        worker thread, and firstPageLoaded is emitted once it is in the table. open_database also connects without
+        blocking the GUI thread.
+        """
+        connection = self._connect(db_type, db)
+        self._apply_connection(connection)
+        self.opened_db = connection[0]
+        self.refresh_data()
+        return '{}'.format(db)
+
+    def open_database(self, db_type, db):
+        """
+        Connects to the database specified on a worker thread. databaseOpened is emitted with db once connected,
+        after which the notes are loaded in the background and firstPageLoaded is emitted once they are in the table.
+        databaseError is emitted instead if the connection fails.
+        """
+        self.connection_id += 1
+        job = QueryJob(self.connection_id, self._connect, db_type, db)
+        job.signals.finished.connect(self._on_connected)
+        job.signals.failed.connect(self._on_connect_failed)
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _on_connected(self, connection_id, connection):
+        if connection_id != self.connection_id:
+            # Another database was requested while this one was connecting
+            connection[1].dispose()
+            connection[2].dispose()
+            return
+        self._apply_connection(connection)
+        self.opened_db = connection[0]
+        self.set_filter(self.pending_filter_txt)
+        self.databaseOpened.emit(connection[0])
+
+    def _on_connect_failed(self, connection_id, error):
+        if connection_id == self.connection_id:
+            self.databaseError.emit(str(error))
+
+    def _connect(self, db_type, db):
+        """
+        Creates the engines for the database specified and makes sure its schema is up to date. Does not modify the
+        model, so it is safe to call from a worker thread. Returns the arguments for _apply_connection.
+        """
         # TODO: Check for existence of db, if not present ask user if they wish to create
-        if self.session:
-            self.session.close()
-        try:
-            engine = create_engine(db_type + db, echo=True)
-            Base.metadata.create_all(engine)
-            dbSession = sessionmaker(bind=engine)
-            self.session = dbSession()
-        except:
-            # Not sure yet what error types we might encounter, so raise everything for now
-            raise
+        # Writes go through a single session while table refreshes, exports and logins check out short-lived
+        # sessions from a separate pool of read-only connections
+        if db_type.startswith('sqlite'):
+            engine = create_engine(db_type + db, connect_args={'check_same_thread': False})
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+            read_engine = create_engine(db_type + db, pool_size=4, max_overflow=0,
+                                        connect_args={'check_same_thread': False})
+            event.listen(read_engine, 'connect', set_sqlite_pragmas)
+            event.listen(read_engine, 'connect', set_sqlite_query_only)
         else:
-            # TODO: Update GUI with db connection status
-            self.refresh_data()
-            logger.debug('Completed db connection to "{}"'.format(db))
-            return '{}'.format(db)
+            engine = create_engine(db_type + db)
+            read_engine = engine
+        event.listen(engine, 'before_cursor_execute', count_sql_statement)
+        if read_engine is not engine:
+            event.listen(read_engine, 'before_cursor_execute', count_sql_statement)
+        Base.metadata.create_all(engine)
+        add_missing_columns(engine)
+        # create_all skips tables that already exist, so add any indexes missing from older databases
+        for mapped_table in Base.metadata.sorted_tables:
+            for index in mapped_table.indexes:
+                index.create(engine, checkfirst=True)
+        use_fts = db_type.startswith('sqlite') and create_note_fts(engine)
+        return db, engine, read_engine, use_fts
+
+    @staticmethod
+    def attachment_dir_for(db):
+        # Attachment files are kept in a directory beside the database, e.g. notes_attachments for notes.db
+        return os.path.splitext(os.path.abspath(db))[0] + '_attachments'
+
+    def watch_database(self, db):
+        """
+        Refreshes the table as soon as the SQLite database file db or its write-ahead log changes. While they are
+        watched the database is only polled every watched_update_rate ms as a fallback, rather than every update_rate
+        ms as when db is None or the files cannot be watched.
+        """
+        if self.dbWatcher.files():
+            self.dbWatcher.removePaths(self.dbWatcher.files())
+        paths = [] if db is None else [p for p in (db, db + '-wal') if os.path.exists(p)]
+        if paths and not self.dbWatcher.addPaths(paths):
+            self.dataUpdateTimer.setInterval(max(self.update_rate, self.watched_update_rate))
+        else:
+            self.dataUpdateTimer.setInterval(self.update_rate)
+        self.dataUpdateTimer.start()
+
+    def _on_database_file_changed(self, path):
+        # Files that are replaced or deleted, such as the log after a checkpoint, stop being watched, so add them back
+        if path not in self.dbWatcher.files() and os.path.exists(path):
+            self.dbWatcher.addPath(path)
+        self.refreshTimer.start()
+
+    def _apply_connection(self, connection):
+        # Switches the model over to the engines created by _connect, discarding the rows of any previous database
+        db, engine, read_engine, use_fts = connection
+        if self.session:
+            self.close()
+        self._cached_query_rows.cache_clear()
+        self._valid_logins.clear()
+        self.read_engine = read_engine
+        self.use_fts = use_fts
+        self.use_sqlite_like = read_engine.dialect.name == 'sqlite'
+        self.attachment_dir = self.attachment_dir_for(db)
+        # Both sessions only run Core statements and never hold ORM objects, so there is nothing to flush before a
+        # query or to expire after a commit
+        dbSession = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+        self.session = dbSession()
+        self.ReadSession = sessionmaker(bind=self.read_engine, autoflush=False, expire_on_commit=False)
+        # Every row is replaced, so reset the model rather than have views remap their indexes through a layout change
+        self.beginResetModel()
+        self.datatable = []
+        self.total_rows = 0
+        self.max_note_id = None
+        self.endResetModel()
+        self.watch_database(db if self.use_sqlite_like else None)
+        # TODO: Update GUI with db connection status
+        logger.debug('Completed db connection to "{}"'.format(db))
 
     def commit_new_note(self, text, user, attachments=None):
         """
         'attachments' is expecting a list of file paths
         """
-        
-        logger.debug('Initiating commit of new note')
-        # TODO: Check for any attachments and add if present
-        # TODO: Use NIST time instead of trusting the computer time
-        datetime = dt.datetime.now()
-        logger.debug('Attempting to add note "{}", "{}", "{}"'.format(datetime, text, user))
-        note = Note(datetime=datetime, text=text, user=user, last_update=datetime)
-        self.session.add(note)
-        if attachments:
-            attach_list = []
-            for attach in attachments:
-                logger.debug('Attempting to add attachment "{}"'.format(attach))
-                with open(attach, 'rb') as fl:
-                    # TODO: Only keep filename/extension, not full path
-                    attach_list.append(Attachment(name=attach, data=buffer(fl.read())))
-        
-        self.session.commit()
-        logger.info('Committed note')
+        return self.commit_notes([(text, user, attachments)])
+
+    def commit_notes(self, notes):
+        """
+        Commits a list of (text, user, attachments) tuples in a single transaction, so a burst of notes costs one write
+        to the database rather than one each. 'attachments' is expecting a list of file paths or None.
+        """
+        return self._notes_written(self._write_notes(notes))
+
+    def start_commit(self, notes):
+        """
+        Runs commit_notes on a worker thread, so copying attachments and waiting on the disk does not block the GUI.
+        notesCommitted is emitted with a status message once the notes are written, or commitError if they could not be.
+        """
+        job = QueryJob(0, self._write_notes, notes)
+        job.signals.finished.connect(self._on_notes_committed)
+        job.signals.failed.connect(self._on_commit_failed)
+        self.writePool.start(job)
+
+    def _on_notes_committed(self, job_id, count):
+        self.notesCommitted.emit(self._notes_written(count))
+
+    def _on_commit_failed(self, job_id, error):
+        self.commitError.emit(str(error))
+
+    def _notes_written(self, count):
+        self._cached_query_rows.cache_clear()
         self.refresh_data()
-        return 'Note Committed Successfully'
+        if count == 1:
+            return 'Note Committed Successfully'
+        return '{} Notes Committed Successfully'.format(count)
+
+    def _write_notes(self, notes):
+        """
+        Inserts notes and their attachments and commits them. Does not modify the model, so it is safe to call from
+        writePool. Returns the number of notes written.
+        """
+        logger.debug('Initiating commit of {} new notes'.format(len(notes)))
+        # Attachment files are copied before the transaction starts, so the database is not locked against other
+        # clients while they are hashed and written. Files are named after their contents, so if the commit fails
+        # they are simply reused by the next note attaching the same file.
+        attach_list = []
+        attach_note_indexes = []
+        for note_index, (text, user, attachments) in enumerate(notes):
+            for attach in attachments or ():
+                logger.debug('Attempting to add attachment "{}"'.format(attach))
+                sha256, path, size = store_attachment_file(attach, self.attachment_dir)
+                # TODO: Only keep filename/extension, not full path
+                attach_list.append({'name': attach, 'sha256': sha256, 'path': path, 'size': size})
+                attach_note_indexes.append(note_index)
+        # TODO: Use NIST time instead of trusting the computer time
+        # The creation and last update times are filled in by SQLite, see LOCAL_TIMESTAMP
+        # A Core insert skips the ORM unit of work, which is pure overhead for rows nothing else refers to
+        try:
+            note_ids = insert_returning_ids(self.session, Note.__table__,
+                                            [{'text': text, 'user': user} for text, user, _ in notes])
+            if attach_list:
+                # The attachments of every note in the batch are inserted with one statement, and their links with
+                # another. Both happen in the same transaction as the notes, so the commit below is a single write.
+                attach_ids = insert_returning_ids(self.session, Attachment.__table__, attach_list)
+                self.session.execute(insert(NoteAttachment),
+                                     [{'note_id': note_ids[note_index], 'attach_id': attach_id}
+                                      for note_index, attach_id in zip(attach_note_indexes, attach_ids)])
+            self.session.commit()
+        except Exception:
+            # Leave the session usable for the next commit
+            self.session.rollback()
+            raise
+        logger.info('Committed {} notes'.format(len(notes)))
+        return len(notes)
 
     def refresh_data(self):
-        # TODO: Add timer to refresh data automatically. Add option to set time in preferences dialog
-        self.layoutAboutToBeChanged.emit()
-        # Collect a list ir dict of all notes and the filenames for all attachments
-        noteslist = self.session.query(Note).order_by(Note.datetime).all()
-        attach_filename_dict = dict((a.attach_id, a.name) for a in self.session.query(Attachment.attach_id, Attachment.name).all())
-        # Also generate a list holding the relationship between the notes and associated attachments
-        notes_attach_list = [(item.note_id, item.attach_id) for item in self.session.query(NoteAttachment).all()]
-        
-        attach_dict = defaultdict(list)
-        self.datatable = []
-        for k,v in notes_attach_list:
-            # Merge all attachments into a single list for each note_id 
-            attach_dict[k].append(v)
-        # Run through all notes, appending any attachments found
-        for note in noteslist:
-            if note.note_id in attach_dict.keys():
-                self.datatable.append([note.datetime, 
-                                       note.text, 
-                                       note.user, 
-                                       note.last_update]+
-                                      ['\n'.join(attach_filename_dict[a] for a in attach_dict[note.note_id])])
-            else:
-                self.datatable.append([note.datetime, note.text, note.user, note.last_update] + [''])
-
-        logger.debug('Fetched new data')
-        self.layoutChanged.emit()
-
-    def export_data(self, path):
-        # Export table data to csv. Assumes path is valid and will be overwritten if exists
-        with open(path, 'w', newline='') as stream:
+        """
+        Appends notes committed since the table was loaded. Only notes newer than max_note_id are queried, so the
+        cost depends on the number of new notes rather than the size of the table. Once the first page is loaded the
+        query runs on a worker thread and notesAppended is emitted when the new rows have been added.
+        """
+        if self.ReadSession is None:
+            return
+        if self.filter_pending:
+            # Notes committed after the running filter query read the newest note id are picked up once it completes
+            self.refresh_after_filter = True
+            return
+        if self.max_note_id is None:
+            # Nothing loaded yet, e.g. because the first filter query failed, so load the first page on a worker thread
+            self.set_filter(self.pending_filter_txt)
+            return
+        # The query runs on a worker thread and the rows are appended once it completes
+        self.refresh_id += 1
+        job = QueryJob(self.refresh_id, self._fetch_new_rows, self.filter_txt, self.max_note_id)
+        job.signals.finished.connect(self._apply_new_rows)
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _apply_new_rows(self, refresh_id, result):
+        filter_txt, after_note_id, rows, max_note_id = result
+        # Results are discarded if a newer refresh or a filter has replaced the rows they were queried against
+        if refresh_id != self.refresh_id or filter_txt != self.filter_txt or after_note_id != self.max_note_id:
+            logger.debug('Discarding stale refresh results')
+            return
+        if not rows:
+            return
+        if self.sort_key[0] != 0:
+            # New notes can belong anywhere when sorted by another column, so reload the table in that order
+            self.set_filter(self.pending_filter_txt)
+            return
+        self.max_note_id = max_note_id
+        if self.sort_key[1]:
+            # Newest first, so new notes go at the top. They are also first in the query order, so the offsets
+            # fetchMore uses stay correct whether or not the table is fully loaded.
+            self.beginInsertRows(QtCore.QModelIndex(), 0, len(rows) - 1)
+            self.datatable[:0] = rows[::-1]
+            self.total_rows += len(rows)
+            self.endInsertRows()
+        elif len(self.datatable) >= self.total_rows:
+            # New notes sort after every existing one, so they are appended to the end of the table
+            first = len(self.datatable)
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + len(rows) - 1)
+            self.datatable.extend(rows)
+            self.total_rows += len(rows)
+            self.endInsertRows()
+        else:
+            # The view has not scrolled to the end yet, so leave the new notes for fetchMore
+            self.total_rows += len(rows)
+        logger.debug('Fetched {} new notes'.format(len(rows)))
+        self.notesAppended.emit(len(rows))
+
+    def set_filter(self, filter_txt):
+        """
+        Limits the table to notes whose text matches the wildcard string filter_txt, ignoring case (on SQLite, for
+        ASCII letters only). The query runs on a worker thread and the table is updated once it completes.
+        """
+        self.pending_filter_txt = filter_txt
+        if self.ReadSession is None:
+            # Not connected yet; the filter is applied once open_database completes
+            return
+        self.query_id += 1
+        self.filter_pending = True
+        job = QueryJob(self.query_id, self._load_rows, filter_txt, self.page_size, self.pending_sort_key)
+        job.signals.finished.connect(self._apply_filter_result)
+        job.signals.failed.connect(self._on_filter_failed)
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _on_filter_failed(self, query_id, error):
+        if query_id == self.query_id:
+            self.filter_pending = False
+            self.refresh_after_filter = False
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """
+        Reloads the table ordered by column in SQL, so every note is sorted rather than only the pages fetched so far,
+        and SQLite can use its datetime index for the default order. The query runs on a worker thread like set_filter.
+        """
+        if column < 0 or column >= len(NOTE_SORT_COLUMNS):
+            return
+        sort_key = (column, order == QtCore.Qt.DescendingOrder)
+        if sort_key == self.pending_sort_key:
+            return
+        self.pending_sort_key = sort_key
+        self.set_filter(self.pending_filter_txt)
+
+    def _apply_filter_result(self, query_id, result):
+        # Results from filters that have since been replaced are discarded
+        if query_id != self.query_id:
+            logger.debug('Discarding stale filter results')
+            return
+        self.filter_pending = False
+        # Refreshes still running were queried against the rows being replaced
+        self.refresh_id += 1
+        self.beginResetModel()
+        self.filter_txt = self.pending_filter_txt
+        self.sort_key = self.pending_sort_key
+        self.total_rows, self.datatable, self.max_note_id = result
+        self.endResetModel()
+        logger.debug('Fetched filtered data')
+        if self.opened_db is not None:
+            opened_db, self.opened_db = self.opened_db, None
+            self.firstPageLoaded.emit(opened_db)
+        if self.refresh_after_filter:
+            self.refresh_after_filter = False
+            self.refresh_data()
+
+    def _load_rows(self, filter_txt, limit, sort_key=DEFAULT_SORT_KEY):
+        """
+        Returns the number of notes matching filter_txt, the table rows for the first limit of them in sort_key order
+        and the newest note id they were loaded up to. Only reads from the database, so it is safe to call from a
+        worker thread.
+        """
+        # Results are cached against the newest note id, so revisiting a filter skips the count and page queries
+        # until another note is committed by this or any other client
+        with self.ReadSession() as session:
+            last_note_id = session.execute(NOTE_MAX_ID).scalar()
+        total_rows, rows = self._cached_query_rows(filter_txt, limit, last_note_id, sort_key)
+        # fetchMore extends datatable in place, so hand out a copy of the cached list
+        return total_rows, list(rows), last_note_id or 0
+
+    def _query_rows(self, filter_txt, limit, last_note_id, sort_key):
+        # Uncached implementation of _load_rows. Notes committed after last_note_id are left for refresh_data.
+        statement, params = self._filter_statement(NOTE_COUNT.where(Note.note_id <= (last_note_id or 0)), filter_txt)
+        with self.ReadSession() as session:
+            total_rows = session.execute(statement, params).scalar()
+        if limit is not None:
+            limit = min(limit, total_rows)
+        return total_rows, self._fetch_rows(last_note_id or 0, limit=limit, filter_txt=filter_txt, sort_key=sort_key)
+
+    def _fetch_new_rows(self, filter_txt, after_note_id):
+        """
+        Returns filter_txt and after_note_id with the table rows for notes matching filter_txt committed after the
+        note after_note_id and the newest note id returned. Only reads from the database, so it is safe to call from
+        a worker thread.
+        """
+        statement, params = self._filter_statement(NOTE_ROWS.where(Note.note_id > after_note_id), filter_txt)
+        statement = statement.order_by(Note.datetime, Note.note_id)
+        with self.ReadSession() as session:
+            notes = session.execute(statement, params).all()
+            if not notes:
+                return filter_txt, after_note_id, [], after_note_id
+            return filter_txt, after_note_id, self._build_rows(notes), max(note.note_id for note in notes)
+
+    def _filter_statement(self, statement, filter_txt):
+        """
+        Applies a text filter, if any, to a select over the note table. Returns the statement together with the
+        parameters to execute it with.
+        """
+        if not filter_txt:
+            return statement, {}
+        pattern = wildcard_to_like(filter_txt)
+        # The trigram index can only narrow the search using a run of at least 3 literal characters, and not at all
+        # for patterns with escaped characters. Otherwise it scans the whole index, which is slower than scanning the
+        # note table directly.
+        longest_run = max(len(part) for part in filter_txt.replace('?', '*').split('*'))
+        if self.use_sqlite_like and (not self.use_fts or longest_run < 3 or '\\' in pattern):
+            criterion = NOTE_TEXT_FILTER_SQLITE
+        elif not self.use_fts:
+            criterion = NOTE_TEXT_FILTER
+        else:
+            criterion = NOTE_FTS_FILTER
+        return statement.where(criterion), {'pattern': pattern}
+
+    def _fetch_rows(self, last_note_id, offset=0, limit=None, filter_txt='', sort_key=DEFAULT_SORT_KEY):
+        """
+        Returns the table rows for notes up to last_note_id matching filter_txt in sort_key order, by creation date
+        unless given, starting at offset. All remaining notes are returned if limit is None.
+        """
+        # Notes committed since last_note_id are left out, so offsets count through the same set of notes as
+        # total_rows even while other clients are adding notes. refresh_data picks the new ones up.
+        statement, params = self._filter_statement(NOTE_ROWS.where(Note.note_id <= last_note_id), filter_txt)
+        statement = statement.order_by(*sort_order(sort_key)).offset(offset)
+        if limit is not None:
+            statement = statement.limit(limit)
+        with self.ReadSession() as session:
+            return self._build_rows(session.execute(statement, params).all())
+
+    def _iter_row_batches(self, filter_txt='', sort_key=DEFAULT_SORT_KEY, batch_size=1000):
+        """
+        Yields lists of NOTE_EXPORT_ROWS rows for every note matching filter_txt in sort_key order, by creation date
+        unless given. Notes are streamed from the database batch_size at a time instead of being loaded all at once.
+        """
+        statement, params = self._filter_statement(NOTE_EXPORT_ROWS, filter_txt)
+        statement = statement.order_by(*sort_order(sort_key))
+        with self.ReadSession() as session:
+            result = session.execute(statement, params, execution_options={'yield_per': batch_size})
+            for rows in result.partitions():
+                yield rows
+
+    def _build_rows(self, noteslist):
+        # Converts NOTE_ROWS results into table rows of display strings. Cells are formatted once here rather than every
+        # time the view asks data() for them.
+        # Rows are never modified once built, so tuples are used as they are a single allocation and smaller than lists
+        # The note_id is kept after the displayed columns so a row can be mapped back to its note, see note_id_at
+        return [('{}'.format(note.datetime), '{}'.format(note.text), '{}'.format(note.user),
+                 '{}'.format(note.last_update), note.attachments or '', note.note_id)
+                for note in noteslist]
+
+    def note_id_at(self, row):
+        # Returns the note_id of the note shown in the given source row
+        return self.datatable[row][len(self.header)]
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return False
+        return len(self.datatable) < self.total_rows
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        # Called by the view as the user scrolls towards the end of the rows fetched so far
+        # Never read past total_rows, as any later notes are appended by refresh_data
+        limit = min(self.page_size, self.total_rows - len(self.datatable))
+        rows = self._fetch_rows(self.max_note_id or 0, offset=len(self.datatable), limit=limit,
+                                filter_txt=self.filter_txt, sort_key=self.sort_key)
+        if not rows:
+            return
+        first = len(self.datatable)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(rows) - 1)
+        self.datatable.extend(rows)
+        self.endInsertRows()
+        logger.debug('Fetched {} more rows'.format(len(rows)))
+
+    def export_data(self, path, filter_txt='', sort_key=DEFAULT_SORT_KEY):
+        # Export the notes matching filter_txt to csv in sort_key order. Assumes path is valid and will be overwritten
+        # if exists. Rows are streamed from the database rather than read from self.datatable, which may only hold the
+        # rows fetched so far. Only reads from the database, so it is safe to call from a worker thread.
+        with open(path, 'w', newline='', encoding='utf-8', buffering=EXPORT_BUFFER_SIZE) as stream:
             writer = csv.writer(stream)
-            rowcount = len(self.datatable)
-            colcount = len(self.datatable[0])
             writer.writerow(self.header)
-            for row in range(rowcount):
-                rowdata = []
-                for column in range(colcount):
-                    item = self.datatable[row][column]
-                    rowdata.append(item)
-                writer.writerow(rowdata)
+            # writerows loops over each batch in C rather than calling writerow for every row
+            for rows in self._iter_row_batches(filter_txt, sort_key):
+                writer.writerows(rows)
+        return path
+
+    def start_export(self, path, filter_txt='', sort_key=DEFAULT_SORT_KEY):
+        """
+        Runs export_data on a worker thread. exportFinished is emitted with path once the file is written, or
+        exportError if it could not be.
+        """
+        job = QueryJob(0, self.export_data, path, filter_txt, sort_key)
+        job.signals.finished.connect(self._on_export_finished)
+        job.signals.failed.connect(self._on_export_failed)
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _on_export_finished(self, job_id, path):
+        self.exportFinished.emit(path)
+
+    def _on_export_failed(self, job_id, error):
+        self.exportError.emit(str(error))
+
+    def save_attachment(self, attach_id, dest_path):
+        """
+        Writes the contents of attachment attach_id to dest_path. Files stored under attachment_dir are copied directly.
+        Attachments from older databases are kept in the data column instead, and are streamed out with sqlite3
+        blobopen so the whole BLOB is never held in memory. The connection is returned to the pool as soon as the copy
+        is done. Only reads from the database, so it is safe to call from a worker thread.
+        """
+        with self.ReadSession() as session:
+            path = session.execute(select(Attachment.path).where(Attachment.attach_id == attach_id)).scalar_one()
+        if path is not None:
+            shutil.copyfile(os.path.join(self.attachment_dir, path), dest_path)
+            return dest_path
+        # blobopen is only available for SQLite from Python 3.11, other databases load the data column in one go
+        if self.read_engine.dialect.name != 'sqlite' or not hasattr(sqlite3.Connection, 'blobopen'):
+            with self.ReadSession() as session:
+                data = session.execute(select(Attachment.data).where(Attachment.attach_id == attach_id)).scalar_one()
+            with open(dest_path, 'wb') as dst:
+                dst.write(data or b'')
+            return dest_path
+        connection = self.read_engine.raw_connection()
+        try:
+            with open(dest_path, 'wb') as dst, \
+                    connection.driver_connection.blobopen('attachment', 'data', attach_id, readonly=True) as blob:
+                shutil.copyfileobj(blob, dst, 1 << 16)
+        finally:
+            connection.close()
+        return dest_path
+
+    def save_note_attachments(self, note_id, directory):
+        # Writes every attachment of note_id into directory under its original file name. Returns directory.
+        statement = select(Attachment.attach_id, Attachment.name).join(
+            NoteAttachment, NoteAttachment.attach_id == Attachment.attach_id).where(NoteAttachment.note_id == note_id)
+        with self.ReadSession() as session:
+            attachments = session.execute(statement).all()
+        for attach_id, name in attachments:
+            self.save_attachment(attach_id, os.path.join(directory, os.path.basename(name)))
+        return directory
+
+    def start_save_attachments(self, note_id, directory):
+        """
+        Runs save_note_attachments on a worker thread. attachmentsSaved is emitted with directory once the files are
+        written, or attachmentsError if they could not be.
+        """
+        job = QueryJob(0, self.save_note_attachments, note_id, directory)
+        job.signals.finished.connect(self._on_attachments_saved)
+        job.signals.failed.connect(self._on_attachments_failed)
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _on_attachments_saved(self, job_id, directory):
+        self.attachmentsSaved.emit(directory)
+
+    def _on_attachments_failed(self, job_id, error):
+        self.attachmentsError.emit(str(error))
             
     def rowCount(self, parent=QtCore.QModelIndex(), *args, **kwargs):
-        try:
-            # count = self.session.query(Note).count()
-            count = len(self.datatable)
-        except AttributeError:
-            return 0
-        else:
-            return count
+        # datatable is created in __init__, so there is no need to guard against it being missing. len() of a list is
+        # already a stored count, so keeping a separate counter in step with datatable would gain nothing.
+        return len(self.datatable)
 
     def columnCount(self, parent=QtCore.QModelIndex(), *args, **kwargs):
         return len(self.header)
@@ -237,20 +1039,76 @@ class NoteTakerTableModel(QtCore.QAbstractTableModel):
             return self.header[p_int]
 
     def data(self, QModelIndex, role=QtCore.Qt.DisplayRole):
-        if role == QtCore.Qt.DisplayRole:
-            i = QModelIndex.row()
-            j = QModelIndex.column()
-            return '{}'.format(self.datatable[i][j])
-        else:
+        # The view asks for several roles per cell on every paint and only DisplayRole has data, so return early
+        if role != QtCore.Qt.DisplayRole:
             return None
+        return self.datatable[QModelIndex.row()][QModelIndex.column()]
 
     def flags(self, QModelIndex):
         return QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled
 
     def close(self):
-        self.session.close()
+        # Stop looking for new notes; _apply_connection starts again for the next database
+        if self.dbWatcher.files():
+            self.dbWatcher.removePaths(self.dbWatcher.files())
+        self.dataUpdateTimer.stop()
+        self.refreshTimer.stop()
+        if self.session:
+            # Let commits and queries still running on the worker threads finish before their engine is disposed
+            self.writePool.waitForDone()
+            QtCore.QThreadPool.globalInstance().waitForDone()
+            self.session.close()
+            self.read_engine.dispose()
+
+    def start_login(self, user, passwd):
+        """
+        Runs is_valid_user on a worker thread, so the password hash does not block the GUI. loginChecked is emitted
+        with the result, or loginError if the credentials could not be checked. Results of checks started before
+        another database was opened are dropped, as they do not apply to it.
+        """
+        if not user or not passwd:
+            # Nothing was entered, e.g. the login dialog was closed without submitting it. The result is still
+            # delivered from the event loop, like that of a real check, rather than before start_login returns.
+            QtCore.QTimer.singleShot(0, functools.partial(self.loginChecked.emit, user or '', False))
+            return
+        job = QueryJob(self.connection_id, self._check_login, user, passwd)
+        job.signals.finished.connect(self._on_login_checked)
+        job.signals.failed.connect(self._on_login_failed)
+        QtCore.QThreadPool.globalInstance().start(job)
+
+    def _check_login(self, user, passwd):
+        return user, self.is_valid_user(user, passwd)
+
+    def _on_login_checked(self, connection_id, result):
+        if connection_id == self.connection_id:
+            self.loginChecked.emit(*result)
+
+    def _on_login_failed(self, connection_id, error):
+        if connection_id == self.connection_id:
+            self.loginError.emit(str(error))
 
     def is_valid_user(self, user, passwd):
-        for un, pwhash in self.session.query(User.username, User.pwhash).filter(User.username == user):
-            logger.debug('Found user in database. {}'.format(un))
-            return pbkdf2_sha256.verify(passwd, pwhash)
+        # Logins that already succeeded against this database are remembered by a keyed digest of the credentials, so
+        # logging in again skips the query and the deliberately slow PBKDF2 hash. Failures are never cached.
+        # The database may be switched while this runs on a worker thread, so keep using the one it started with
+        read_session = self.ReadSession
+        if not user or not passwd or read_session is None:
+            # No credentials or no database to check them against, so there is nothing to hide the timing of
+            return False
+        login_key = hashlib.blake2b('{}\0{}'.format(user, passwd).encode('utf-8'), key=self._login_key).digest()
+        if login_key in self._valid_logins:
+            return True
+        # username is unique, so the lookup is a single indexed row fetch
+        with read_session() as session:
+            pwhash = session.execute(USER_PWHASH, {'username': user}).scalar_one_or_none()
+        if not pwhash:
+            # Unknown users and accounts without a password are rejected, after the same amount of hashing
+            verify_password(passwd, DUMMY_PWHASH)
+            return False
+        logger.debug('Found user in database. {}'.format(user))
+        if verify_password(passwd, pwhash):
+            if read_session is self.ReadSession:
+                # Not remembered if another database was opened meanwhile, as it was not checked against that one
+                self._valid_logins.add(login_key)
+            return True
+        return False